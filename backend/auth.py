@@ -3,33 +3,138 @@ Backend auth.py - Authentication and Authorization Utilities
 Save this as: backend/auth.py
 """
 
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from calendar import timegm
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Deque, Dict, Final, Optional, OrderedDict as OrderedDictType, Tuple
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import ssl
+import threading
+import time
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import JWTError, jwt
-from passlib.context import CryptContext
 from sqlalchemy.orm import Session
 import bcrypt
+import jwt
+import orjson
 
-from database import get_db, Doctor
+from database import get_db, Doctor, Analysis
 
 # Security Configuration
-SECRET_KEY = "your-secret-key-change-in-production"  # CHANGE THIS IN PRODUCTION!
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
+SECRET_KEY: Final[str] = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")  # CHANGE THIS IN PRODUCTION!
+_SECRET_KEY_BYTES: Final[bytes] = SECRET_KEY.encode()  # encoded once for HMAC
+ALGORITHM: Final[str] = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES: Final[int] = 1440  # 24 hours
 
-# Password hashing context
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Verified token cache (keyed by a digest of the raw token)
+TOKEN_CACHE_MAX_SIZE = 10_000
+TOKEN_CACHE_TTL_SECONDS = 60
+
+# Password hashing configuration
+BCRYPT_DEFAULT_COST = 12
+BCRYPT_TARGET_MS = int(os.getenv("BCRYPT_TARGET_MS", "250"))
+BCRYPT_PREFIXES = ("$2a$", "$2b$", "$2y$")
+BCRYPT_HASH_LENGTH = 60
 
 # HTTP Bearer for token authentication
 security = HTTPBearer()
 
+# Response parts shared by every credential failure
+_WWW_AUTH = {"WWW-Authenticate": "Bearer"}
+_CREDENTIALS_DETAIL = "Could not validate credentials"
+
+
+def _credentials_exception() -> HTTPException:
+    """
+    Build the 401 raised for any invalid or missing credentials
+    
+    A new instance per raise: exceptions carry per-raise traceback and
+    context state, so one instance must not be shared between threads.
+    
+    Returns:
+        HTTPException with status 401 and a Bearer challenge
+    """
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=_CREDENTIALS_DETAIL,
+        headers=_WWW_AUTH,
+    )
+
 
 # ============================================================================
 # Password Hashing Functions
 # ============================================================================
 
+def _calibrate_cost(target_ms: int = 250, min_cost: int = 10, max_cost: int = 14) -> int:
+    """
+    Pick the largest bcrypt cost whose hash time stays under a latency budget
+    
+    Each extra round doubles the hashing time, so calibration stops at the
+    first cost that exceeds the budget.
+    
+    Args:
+        target_ms: Maximum acceptable hashing time in milliseconds
+        min_cost: Lowest cost considered (used even if it exceeds the budget)
+        max_cost: Highest cost considered
+        
+    Returns:
+        Selected bcrypt cost
+    """
+    cost = min_cost
+    for rounds in range(min_cost, max_cost + 1):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"x" * 16, bcrypt.gensalt(rounds=rounds))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms > target_ms:
+            break
+        cost = rounds
+    return cost
+
+
+# Explicit BCRYPT_COST wins; BCRYPT_CALIBRATE=1 is applied by start_bcrypt_pool()
+BCRYPT_COST = int(os.getenv("BCRYPT_COST") or BCRYPT_DEFAULT_COST)
+
+# Worker processes for bcrypt, started and stopped by the app lifespan
+_BCRYPT_POOL: Optional[ProcessPoolExecutor] = None
+
+
+def start_bcrypt_pool():
+    """
+    Settle the bcrypt cost and start the hashing worker processes
+    
+    Call once from the app lifespan. Calibration runs here, in the parent
+    only. Workers are spawned rather than forked from the multi-threaded
+    server, and they only run bcrypt's own functions with a salt that already
+    carries the cost, so they never import this module or calibrate again.
+    """
+    global BCRYPT_COST, _BCRYPT_POOL
+    
+    if not os.getenv("BCRYPT_COST") and os.getenv("BCRYPT_CALIBRATE", "").lower() in ("1", "true", "yes"):
+        BCRYPT_COST = _calibrate_cost(BCRYPT_TARGET_MS)
+    print(f"Using bcrypt cost {BCRYPT_COST}")
+    
+    if _BCRYPT_POOL is None:
+        _BCRYPT_POOL = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+
+def shutdown_bcrypt_pool():
+    """Stop the bcrypt worker processes started by start_bcrypt_pool()"""
+    global _BCRYPT_POOL
+    
+    if _BCRYPT_POOL is not None:
+        _BCRYPT_POOL.shutdown()
+        _BCRYPT_POOL = None
+
+
 def hash_password(password: str) -> str:
     """
     Hash a plain text password using bcrypt
@@ -40,7 +145,17 @@ def hash_password(password: str) -> str:
     Returns:
         Hashed password string
     """
-    return pwd_context.hash(password)
+    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_COST))
+    return hashed.decode()
+
+
+def _is_bcrypt_hash(hashed_password: str) -> bool:
+    """Check the shape of a stored hash so bcrypt is never handed garbage"""
+    return (
+        bool(hashed_password)
+        and len(hashed_password) == BCRYPT_HASH_LENGTH
+        and hashed_password.startswith(BCRYPT_PREFIXES)
+    )
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -54,17 +169,83 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     Returns:
         True if password matches, False otherwise
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    # Reject malformed hashes up front instead of letting bcrypt raise
+    if not _is_bcrypt_hash(hashed_password):
+        return False
+    
+    return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+
+
+async def hash_password_async(password: str) -> str:
+    """
+    Hash a plain text password in the bcrypt process pool
+    
+    Falls back to the default thread pool when the process pool is not running.
+    
+    Args:
+        password: Plain text password
+        
+    Returns:
+        Hashed password string
+    """
+    loop = asyncio.get_running_loop()
+    # The salt carries BCRYPT_COST, so the worker hashes with the parent's cost
+    hashed = await loop.run_in_executor(
+        _BCRYPT_POOL, bcrypt.hashpw, password.encode(), bcrypt.gensalt(rounds=BCRYPT_COST)
+    )
+    return hashed.decode()
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    """
+    Verify a plain text password in the bcrypt process pool
+    
+    Falls back to the default thread pool when the process pool is not running.
+    
+    Args:
+        plain_password: Plain text password to verify
+        hashed_password: Hashed password from database
+        
+    Returns:
+        True if password matches, False otherwise
+    """
+    if not _is_bcrypt_hash(hashed_password):
+        return False
+    
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _BCRYPT_POOL, bcrypt.checkpw, plain_password.encode(), hashed_password.encode()
+    )
 
 
 # ============================================================================
 # JWT Token Functions
 # ============================================================================
 
+# HMAC digest for each supported ALGORITHM
+_HMAC_DIGESTS = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+
+# Every token uses ALGORITHM, so the header and keyed HMAC state are built
+# once and reused for every token
+_JWT_HEADER_B64 = base64.urlsafe_b64encode(orjson.dumps({"alg": ALGORITHM, "typ": "JWT"})).rstrip(b"=")
+_HMAC_TEMPLATE = hmac.new(_SECRET_KEY_BYTES, digestmod=_HMAC_DIGESTS[ALGORITHM])
+
+# Registered claims that hold a NumericDate (seconds since the epoch)
+_NUMERIC_DATE_CLAIMS = ("exp", "iat", "nbf")
+
+
+def _b64url(data: bytes) -> bytes:
+    """Base64url-encode without padding, as required by JWS"""
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
     Create a JWT access token
     
+    Claims are encoded the way PyJWT would: datetime values of exp/iat/nbf
+    become NumericDate integers, and sub is always a string (RFC 7519).
+    
     Args:
         data: Dictionary containing claims to encode in the token
         expires_delta: Optional expiration time delta
@@ -75,14 +256,129 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     to_encode = data.copy()
     
     if expires_delta:
-        expire = datetime.utcnow() + expires_delta
+        lifetime = expires_delta.total_seconds()
     else:
-        expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        lifetime = ACCESS_TOKEN_EXPIRE_MINUTES * 60
+    
+    for claim in _NUMERIC_DATE_CLAIMS:
+        if isinstance(to_encode.get(claim), datetime):
+            to_encode[claim] = timegm(to_encode[claim].utctimetuple())
+    if "sub" in to_encode:
+        to_encode["sub"] = str(to_encode["sub"])
+    
+    # exp is a numeric epoch, so skip building datetimes
+    to_encode["exp"] = int(time.time() + lifetime)
+    payload = orjson.dumps(to_encode)
+    signing_input = _JWT_HEADER_B64 + b"." + _b64url(payload)
+    
+    mac = _HMAC_TEMPLATE.copy()
+    mac.update(signing_input)
+    encoded_jwt = signing_input + b"." + _b64url(mac.digest())
+    
+    return encoded_jwt.decode()
+
+
+class _OrjsonJWT(jwt.PyJWT):
+    """PyJWT decoder that parses the claims segment with orjson"""
     
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    def _decode_payload(self, decoded: dict) -> dict:
+        try:
+            payload = orjson.loads(decoded["payload"])
+        except orjson.JSONDecodeError as e:
+            raise jwt.DecodeError(f"Invalid payload string: {e}")
+        if not isinstance(payload, dict):
+            raise jwt.DecodeError("Invalid payload string: must be a json object")
+        return payload
+
+
+_jwt_decoder = _OrjsonJWT()
+
+
+def _check_hmac_backend():
+    """
+    Warn if HS256 would not run on OpenSSL's SHA-256
+    
+    PyJWT signs with hmac/hashlib, which delegate to OpenSSL when CPython is
+    built against it; OpenSSL >= 1.1.1 picks the SHA-NI code path on CPUs
+    that support it. The builtin fallback is several times slower.
+    """
+    if getattr(hashlib.sha256, "__name__", "") != "openssl_sha256":
+        print("Warning: hashlib is not OpenSSL-backed, JWT HMAC-SHA256 will be slow")
+    elif ssl.OPENSSL_VERSION_INFO < (1, 1, 1):
+        print(f"Warning: {ssl.OPENSSL_VERSION} is too old for accelerated SHA-256, upgrade to 1.1.1+")
+
+
+_check_hmac_backend()
+
+
+# digest -> (expires_at, claims), kept in insertion order for eviction
+_token_cache: OrderedDictType[bytes, Tuple[float, dict]] = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+def _token_cache_key(token: str) -> bytes:
+    """Digest used as cache key so raw tokens are never kept in memory"""
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def get_cached_claims(token: str) -> Optional[dict]:
+    """
+    Look up the claims of a previously verified token
+    
+    Args:
+        token: JWT token string
+        
+    Returns:
+        Cached claims, or None if the token is not cached or its entry expired
+    """
+    key = _token_cache_key(token)
+    entry = _token_cache.get(key)
+    if entry is None:
+        return None
     
-    return encoded_jwt
+    expires_at, claims = entry
+    if time.time() >= expires_at:
+        with _token_cache_lock:
+            # Another thread may have re-cached the token meanwhile
+            if _token_cache.get(key) is entry:
+                del _token_cache[key]
+        return None
+    
+    return claims
+
+
+def cache_claims(token: str, claims: dict):
+    """
+    Remember the claims of a token that passed signature verification
+    
+    Entries live for TOKEN_CACHE_TTL_SECONDS, but never past the token's
+    own exp claim. Only call this after a successful decode.
+    
+    Args:
+        token: JWT token string
+        claims: Decoded claims of the verified token
+    """
+    now = time.time()
+    expires_at = now + TOKEN_CACHE_TTL_SECONDS
+    exp = claims.get("exp")
+    if isinstance(exp, (int, float)):
+        expires_at = min(expires_at, exp)
+    if expires_at <= now:
+        return
+    
+    key = _token_cache_key(token)
+    with _token_cache_lock:
+        # Re-caching moves the token to the back so the order stays by insertion
+        _token_cache.pop(key, None)
+        
+        # Every entry lives at most TOKEN_CACHE_TTL_SECONDS, so the oldest
+        # entries are at the front: drop expired heads, then one head if full
+        while _token_cache and next(iter(_token_cache.values()))[0] <= now:
+            _token_cache.popitem(last=False)
+        if len(_token_cache) >= TOKEN_CACHE_MAX_SIZE:
+            _token_cache.popitem(last=False)
+        
+        _token_cache[key] = (expires_at, claims)
 
 
 def decode_access_token(token: str) -> dict:
@@ -98,15 +394,16 @@ def decode_access_token(token: str) -> dict:
     Raises:
         HTTPException: If token is invalid or expired
     """
+    payload = get_cached_claims(token)
+    if payload is not None:
+        return payload
+    
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _jwt_decoder.decode(token, _SECRET_KEY_BYTES, algorithms=[ALGORITHM])
+        cache_claims(token, payload)
         return payload
-    except JWTError as e:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"Could not validate credentials: {str(e)}",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+    except jwt.PyJWTError:
+        raise _credentials_exception() from None
 
 
 # ============================================================================
@@ -128,28 +425,13 @@ def get_current_doctor_id(
     Raises:
         HTTPException: If token is invalid, expired, or missing doctor ID
     """
+    payload = decode_access_token(credentials.credentials)
+    
+    # sub is a string in new tokens; older tokens carry the bare integer
     try:
-        token = credentials.credentials
-        payload = decode_access_token(token)
-        doctor_id: int = payload.get("sub")
-        
-        if doctor_id is None:
-            raise HTTPException(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                detail="Invalid authentication credentials",
-                headers={"WWW-Authenticate": "Bearer"},
-            )
-        
-        return doctor_id
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail=f"Authentication failed: {str(e)}",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+        return int(payload["sub"])
+    except (KeyError, TypeError, ValueError):
+        raise _credentials_exception() from None
 
 
 def get_current_doctor(
@@ -237,79 +519,92 @@ def create_doctor_token(doctor: Doctor) -> dict:
 # Authorization Helper Functions
 # ============================================================================
 
-def check_doctor_owns_analysis(doctor_id: int, analysis_doctor_id: int) -> bool:
+def get_owned_analysis(db: Session, analysis_id: int, doctor_id: int, *options) -> Analysis:
     """
-    Check if a doctor owns a specific analysis
+    Fetch an analysis owned by a doctor, checking ownership in the query
     
     Args:
+        db: Database session
+        analysis_id: ID of the requested analysis
         doctor_id: ID of current doctor
-        analysis_doctor_id: ID of doctor who created the analysis
+        *options: Extra loader options for the query (e.g. joinedload)
         
     Returns:
-        True if doctor owns the analysis, False otherwise
-    """
-    return doctor_id == analysis_doctor_id
-
-
-def require_doctor_owns_analysis(doctor_id: int, analysis_doctor_id: int):
-    """
-    Require that a doctor owns a specific analysis, raise exception if not
-    
-    Args:
-        doctor_id: ID of current doctor
-        analysis_doctor_id: ID of doctor who created the analysis
+        Analysis object from database
         
     Raises:
-        HTTPException: If doctor doesn't own the analysis
+        HTTPException: If the analysis doesn't exist or belongs to another doctor
     """
-    if not check_doctor_owns_analysis(doctor_id, analysis_doctor_id):
+    analysis = db.query(Analysis).options(*options).filter(
+        Analysis.id == analysis_id,
+        Analysis.doctor_id == doctor_id
+    ).first()
+    
+    if analysis is None:
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You don't have permission to access this resource"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Analysis not found"
         )
+    
+    return analysis
 
 
 # ============================================================================
 # Token Validation Functions
 # ============================================================================
 
+def _peek_exp(token: str) -> Optional[float]:
+    """
+    Read the exp claim of a JWT without verifying its signature
+    
+    The value is unauthenticated: use it to decide when to refresh a token,
+    never to grant access (decode_access_token does that).
+    """
+    try:
+        _, payload_b64, _ = token.split(".")
+        padding = "=" * (-len(payload_b64) % 4)
+        claims = orjson.loads(base64.urlsafe_b64decode(payload_b64 + padding))
+    except (ValueError, TypeError):
+        return None
+    
+    exp = claims.get("exp") if isinstance(claims, dict) else None
+    return exp if isinstance(exp, (int, float)) else None
+
+
 def is_token_expired(token: str) -> bool:
     """
-    Check if a JWT token is expired
+    Check if a JWT token is expired (signature is not verified)
     
     Args:
         token: JWT token string
         
     Returns:
-        True if token is expired, False otherwise
+        True if token is expired or unreadable, False otherwise
     """
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        exp = payload.get("exp")
-        if exp is None:
-            return True
-        return datetime.utcnow() > datetime.fromtimestamp(exp)
-    except JWTError:
+    exp = _peek_exp(token)
+    if exp is None:
         return True
+    return time.time() > exp
 
 
 def get_token_expiration(token: str) -> Optional[datetime]:
     """
-    Get the expiration datetime of a JWT token
+    Get the expiration datetime of a JWT token (signature is not verified)
     
     Args:
         token: JWT token string
         
     Returns:
-        Datetime object of token expiration, or None if invalid
+        Datetime object of token expiration, or None if unreadable
     """
+    exp = _peek_exp(token)
+    if exp is None:
+        return None
+    
+    # exp is unverified input and may lie outside the platform's datetime range
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        exp = payload.get("exp")
-        if exp is None:
-            return None
         return datetime.fromtimestamp(exp)
-    except JWTError:
+    except (OverflowError, OSError, ValueError):
         return None
 
 
@@ -324,34 +619,56 @@ class RateLimiter:
     """
     
     def __init__(self):
-        self.attempts = {}  # email -> list of attempt timestamps
         self.max_attempts = 5
         self.window_seconds = 300  # 5 minutes
+        # email -> monotonic times of the most recent attempts (at most max_attempts)
+        self.attempts: Dict[str, Deque[float]] = {}
+        self._next_sweep = time.monotonic() + self.window_seconds
+    
+    def _prune(self, attempts: Deque[float], now: float):
+        """Drop attempts that fell outside the window (oldest first)"""
+        cutoff = now - self.window_seconds
+        while attempts and attempts[0] <= cutoff:
+            attempts.popleft()
     
     def is_rate_limited(self, email: str) -> bool:
         """Check if email is rate limited"""
-        now = datetime.utcnow()
+        attempts = self.attempts.get(email)
         
-        if email not in self.attempts:
+        if not attempts:
             return False
         
-        # Remove old attempts outside the window
-        self.attempts[email] = [
-            timestamp for timestamp in self.attempts[email]
-            if (now - timestamp).total_seconds() < self.window_seconds
-        ]
+        self._prune(attempts, time.monotonic())
         
         # Check if too many attempts
-        return len(self.attempts[email]) >= self.max_attempts
+        return len(attempts) >= self.max_attempts
     
     def record_attempt(self, email: str):
         """Record a failed authentication attempt"""
-        now = datetime.utcnow()
+        now = time.monotonic()
+        
+        attempts = self.attempts.get(email)
+        if attempts is None:
+            attempts = self.attempts[email] = deque(maxlen=self.max_attempts)
+        
+        attempts.append(now)
         
-        if email not in self.attempts:
-            self.attempts[email] = []
+        if now >= self._next_sweep:
+            self.sweep(now)
+    
+    def sweep(self, now: Optional[float] = None):
+        """Forget emails whose last attempt is outside the window"""
+        now = time.monotonic() if now is None else now
+        cutoff = now - self.window_seconds
+        
+        stale = [
+            email for email, attempts in self.attempts.items()
+            if not attempts or attempts[-1] <= cutoff
+        ]
+        for email in stale:
+            del self.attempts[email]
         
-        self.attempts[email].append(now)
+        self._next_sweep = now + self.window_seconds
     
     def clear_attempts(self, email: str):
         """Clear attempts for an email (after successful login)"""
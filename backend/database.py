@@ -2,7 +2,7 @@
 Database models and configuration using SQLAlchemy
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text
+from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text, Index, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -10,6 +10,26 @@ from datetime import datetime
 SQLALCHEMY_DATABASE_URL = "sqlite:///./medical_cdss.db"
 
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+
+# WAL lets reads proceed during writes; NORMAL sync is safe under WAL
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -51,9 +71,13 @@ class Patient(Base):
 
 class Analysis(Base):
     __tablename__ = "analyses"
+    __table_args__ = (
+        # Per-doctor listings ordered by time; also serves plain doctor_id lookups
+        Index("ix_analyses_doctor_timestamp", "doctor_id", "timestamp"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
-    patient_id = Column(Integer, ForeignKey("patients.id"))
+    patient_id = Column(Integer, ForeignKey("patients.id"), index=True)
     doctor_id = Column(Integer, ForeignKey("doctors.id"))
     disease = Column(String, nullable=False)
     severity = Column(String)
@@ -67,6 +91,7 @@ class Analysis(Base):
     image_path = Column(String)
     gradcam_path = Column(String)
     report_path = Column(String)
+    report_status = Column(String, default="pending")  # pending, ready or failed
     timestamp = Column(DateTime, default=datetime.utcnow)
     
     patient = relationship("Patient", back_populates="analyses")
@@ -3,32 +3,68 @@ FastAPI Backend for Medical CDSS
 Run with: uvicorn main:app --reload
 """
 
-from fastapi import FastAPI, File, UploadFile, Depends, HTTPException, status, Form
+from fastapi import (
+    FastAPI, File, UploadFile, Depends, HTTPException, status, Form, Request, Response,
+    BackgroundTasks
+)
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, JSONResponse
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from datetime import datetime, timedelta
+from sqlalchemy import case, func, inspect, text
+from sqlalchemy.orm import Session, joinedload
+from contextlib import asynccontextmanager
 from typing import Optional, List
-import shutil
+import asyncio
+import hashlib
 import os
+import secrets
 from pathlib import Path
-import jwt
-import bcrypt
+import aiofiles
 
 from models import (
     DoctorCreate, DoctorLogin, PatientRecord, AnalysisRequest,
     AnalysisResponse, Token
 )
-from database import engine, Base, get_db, Doctor, Patient, Analysis
-from ml_inference import ModelInference
+from database import engine, Base, SessionLocal, get_db, Doctor, Patient, Analysis
+from auth import (
+    hash_password_async, verify_password_async, create_access_token, get_current_doctor_id,
+    get_owned_analysis, start_bcrypt_pool, shutdown_bcrypt_pool
+)
+from ml_inference import ImageDecodeError, get_model_inference
 from report_generator import generate_pdf_report
 
 # Create tables
 Base.metadata.create_all(bind=engine)
 
+# create_all skips existing tables, so add indexes missing from older databases
+for index in Analysis.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+
+# ...and the report_status column; older rows got their report synchronously,
+# so a missing report_path there means generation failed
+if "report_status" not in {column["name"] for column in inspect(engine).get_columns("analyses")}:
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE analyses ADD COLUMN report_status VARCHAR"))
+        connection.execute(text(
+            "UPDATE analyses SET report_status = "
+            "CASE WHEN report_path IS NULL THEN 'failed' ELSE 'ready' END"
+        ))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the model and start worker pools with the app, stop the pools on shutdown"""
+    start_bcrypt_pool()
+    try:
+        # Loading can take minutes (ONNX export, TensorRT build, CUDA graphs),
+        # so it runs off the event loop before the first request is accepted
+        await asyncio.to_thread(get_model_inference, MODEL_PATH, INFERENCE_BACKEND)
+        yield
+    finally:
+        shutdown_bcrypt_pool()
+
+
 # Initialize FastAPI
-app = FastAPI(title="Medical CDSS API", version="1.0.0")
+app = FastAPI(title="Medical CDSS API", version="1.0.0", lifespan=lifespan)
 
 # CORS Configuration
 app.add_middleware(
@@ -39,14 +75,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Security
-security = HTTPBearer()
-SECRET_KEY = "your-secret-key-change-in-production"  # Change this!
-ALGORITHM = "HS256"
-ACCESS_TOKEN_EXPIRE_MINUTES = 1440  # 24 hours
+# ML Model, loaded once per process at startup
+# (INFERENCE_BACKEND=onnx serves it through ONNX Runtime).
+# Each uvicorn worker holds its own copy of the weights.
+MODEL_PATH = "models/pneumonia_model.pkl"
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
 
-# Initialize ML Model
-model_inference = ModelInference("models/pneumonia_model.pkl")
+# Upload streaming
+UPLOAD_CHUNK_SIZE = 64 * 1024
 
 # Create necessary directories
 Path("uploads").mkdir(exist_ok=True)
@@ -54,29 +90,73 @@ Path("reports").mkdir(exist_ok=True)
 
 
 # ============================================================================
-# Authentication Functions
+# Response Caching
 # ============================================================================
 
-def create_access_token(data: dict):
-    to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+def analyses_etag(db: Session, doctor_id: int) -> str:
+    """ETag that changes whenever a doctor's analyses or their reports change"""
+    latest, total, reports, failed = db.query(
+        func.max(Analysis.timestamp), func.count(), func.count(Analysis.report_path),
+        func.sum(case((Analysis.report_status == "failed", 1), else_=0))
+    ).filter(Analysis.doctor_id == doctor_id).one()
+    
+    digest = hashlib.blake2b(
+        f"{doctor_id}:{latest}:{total}:{reports}:{failed}".encode(), digest_size=8
+    ).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check the client's If-None-Match header against an ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
 
+def set_cache_headers(response: Response, etag: str):
+    """Let browsers keep the response but revalidate it on every request"""
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "private, no-cache"
 
-def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+
+# ============================================================================
+# Background Reports
+# ============================================================================
+
+def generate_report_task(analysis_id: int, prediction: dict):
+    """Render the PDF report after the response is sent and record its path (or the failure)"""
+    db = SessionLocal()
     try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        doctor_id: int = payload.get("sub")
-        if doctor_id is None:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        return doctor_id
-    except jwt.ExpiredSignatureError:
-        raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.JWTError:
-        raise HTTPException(status_code=401, detail="Invalid token")
+        analysis = db.query(Analysis).options(
+            joinedload(Analysis.patient), joinedload(Analysis.doctor)
+        ).filter(Analysis.id == analysis_id).first()
+        if analysis is None:
+            return
+        
+        analysis.report_path = generate_pdf_report(
+            analysis=analysis,
+            patient=analysis.patient,
+            doctor=analysis.doctor,
+            prediction=prediction
+        )
+        analysis.report_status = "ready"
+        db.commit()
+    except Exception as e:
+        print(f"Report generation failed for analysis {analysis_id}: {e}")
+        # Record the failure so clients stop waiting for the report
+        try:
+            db.rollback()
+            db.query(Analysis).filter(Analysis.id == analysis_id).update(
+                {Analysis.report_status: "failed"}
+            )
+            db.commit()
+        except Exception as mark_error:
+            print(f"Could not mark report of analysis {analysis_id} as failed: {mark_error}")
+    finally:
+        db.close()
 
 
 # ============================================================================
@@ -96,14 +176,11 @@ async def register_doctor(doctor: DoctorCreate, db: Session = Depends(get_db)):
     if existing_doctor:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    # Hash password
-    hashed_password = bcrypt.hashpw(doctor.password.encode(), bcrypt.gensalt())
-    
     # Create doctor
     new_doctor = Doctor(
         name=doctor.name,
         email=doctor.email,
-        password=hashed_password.decode(),
+        password=await hash_password_async(doctor.password),
         specialty=doctor.specialty,
         license_number=doctor.license_number
     )
@@ -131,7 +208,7 @@ async def login_doctor(credentials: DoctorLogin, db: Session = Depends(get_db)):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # Verify password
-    if not bcrypt.checkpw(credentials.password.encode(), doctor.password.encode()):
+    if not await verify_password_async(credentials.password, doctor.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # Create token
@@ -147,6 +224,7 @@ async def login_doctor(credentials: DoctorLogin, db: Session = Depends(get_db)):
 
 @app.post("/api/analyze", response_model=AnalysisResponse)
 async def analyze_xray(
+    background_tasks: BackgroundTasks,
     image: UploadFile = File(...),
     patient_name: str = Form(...),
     patient_age: int = Form(...),
@@ -157,19 +235,21 @@ async def analyze_xray(
     oxygen_saturation: Optional[int] = Form(None),
     heart_rate: Optional[int] = Form(None),
     respiratory_rate: Optional[int] = Form(None),
-    doctor_id: int = Depends(verify_token),
+    doctor_id: int = Depends(get_current_doctor_id),
     db: Session = Depends(get_db)
 ):
     """Analyze chest X-ray and generate diagnosis"""
     
-    # Save uploaded image temporarily
-    image_path = f"uploads/{datetime.now().timestamp()}_{image.filename}"
-    with open(image_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
+    # Save uploaded image temporarily (random name, keep only the extension)
+    image_path = f"uploads/{secrets.token_hex(8)}{Path(image.filename or '').suffix}"
+    async with aiofiles.open(image_path, "wb") as buffer:
+        while chunk := await image.read(UPLOAD_CHUNK_SIZE):
+            await buffer.write(chunk)
     
     try:
-        # Run ML inference
-        prediction = model_inference.predict(image_path)
+        # Run ML inference (the model was loaded by the lifespan hook)
+        model_inference = get_model_inference(MODEL_PATH, INFERENCE_BACKEND)
+        prediction = await model_inference.predict_async(image_path)
         
         # Create or get patient
         patient = db.query(Patient).filter(Patient.name == patient_name).first()
@@ -204,18 +284,8 @@ async def analyze_xray(
         db.commit()
         db.refresh(analysis)
         
-        # Generate PDF report
-        doctor = db.query(Doctor).filter(Doctor.id == doctor_id).first()
-        report_path = generate_pdf_report(
-            analysis=analysis,
-            patient=patient,
-            doctor=doctor,
-            prediction=prediction
-        )
-        
-        # Update analysis with report path
-        analysis.report_path = report_path
-        db.commit()
+        # Generate PDF report once the response is sent
+        background_tasks.add_task(generate_report_task, analysis.id, prediction)
         
         return AnalysisResponse(
             analysis_id=analysis.id,
@@ -225,10 +295,16 @@ async def analyze_xray(
             affected_regions=prediction['affected_regions'],
             recommendations=prediction['recommendations'],
             gradcam_image=prediction['gradcam_path'],
-            report_path=report_path,
+            report_status="pending",
+            report_url=f"/api/download/report/{analysis.id}",
             timestamp=analysis.timestamp.isoformat()
         )
         
+    except ImageDecodeError as e:
+        if os.path.exists(image_path):
+            os.remove(image_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    
     except Exception as e:
         # Clean up uploaded file on error
         if os.path.exists(image_path):
@@ -238,15 +314,29 @@ async def analyze_xray(
 
 @app.get("/api/records")
 async def get_patient_records(
-    doctor_id: int = Depends(verify_token),
+    request: Request,
+    response: Response,
+    doctor_id: int = Depends(get_current_doctor_id),
     db: Session = Depends(get_db)
 ):
     """Get all patient records for logged-in doctor"""
-    analyses = db.query(Analysis).filter(Analysis.doctor_id == doctor_id).order_by(Analysis.timestamp.desc()).all()
+    etag = analyses_etag(db, doctor_id)
+    if etag_matches(request, etag):
+        not_modified = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+        set_cache_headers(not_modified, etag)
+        return not_modified
+    
+    analyses = (
+        db.query(Analysis)
+        .options(joinedload(Analysis.patient))
+        .filter(Analysis.doctor_id == doctor_id)
+        .order_by(Analysis.timestamp.desc())
+        .all()
+    )
     
     records = []
     for analysis in analyses:
-        patient = db.query(Patient).filter(Patient.id == analysis.patient_id).first()
+        patient = analysis.patient
         records.append({
             "id": analysis.id,
             "patient_name": patient.name,
@@ -256,28 +346,23 @@ async def get_patient_records(
             "severity": analysis.severity,
             "confidence": analysis.confidence,
             "timestamp": analysis.timestamp.isoformat(),
-            "report_available": analysis.report_path is not None
+            "report_available": analysis.report_path is not None,
+            "report_status": analysis.report_status
         })
     
+    set_cache_headers(response, etag)
     return {"records": records}
 
 
 @app.get("/api/records/{analysis_id}")
 async def get_analysis_detail(
     analysis_id: int,
-    doctor_id: int = Depends(verify_token),
+    doctor_id: int = Depends(get_current_doctor_id),
     db: Session = Depends(get_db)
 ):
     """Get detailed analysis information"""
-    analysis = db.query(Analysis).filter(
-        Analysis.id == analysis_id,
-        Analysis.doctor_id == doctor_id
-    ).first()
-    
-    if not analysis:
-        raise HTTPException(status_code=404, detail="Analysis not found")
-    
-    patient = db.query(Patient).filter(Patient.id == analysis.patient_id).first()
+    analysis = get_owned_analysis(db, analysis_id, doctor_id, joinedload(Analysis.patient))
+    patient = analysis.patient
     
     return {
         "patient": {
@@ -307,22 +392,22 @@ async def get_analysis_detail(
 @app.get("/api/download/report/{analysis_id}")
 async def download_report(
     analysis_id: int,
-    doctor_id: int = Depends(verify_token),
+    doctor_id: int = Depends(get_current_doctor_id),
     db: Session = Depends(get_db)
 ):
     """Download PDF report"""
-    analysis = db.query(Analysis).filter(
-        Analysis.id == analysis_id,
-        Analysis.doctor_id == doctor_id
-    ).first()
+    analysis = get_owned_analysis(db, analysis_id, doctor_id, joinedload(Analysis.patient))
+    
+    if analysis.report_status == "failed":
+        raise HTTPException(status_code=500, detail="Report generation failed")
     
-    if not analysis or not analysis.report_path:
-        raise HTTPException(status_code=404, detail="Report not found")
+    if not analysis.report_path:
+        raise HTTPException(status_code=404, detail="Report not ready")
     
     if not os.path.exists(analysis.report_path):
         raise HTTPException(status_code=404, detail="Report file not found")
     
-    patient = db.query(Patient).filter(Patient.id == analysis.patient_id).first()
+    patient = analysis.patient
     filename = f"report_{patient.name}_{analysis.timestamp.strftime('%Y%m%d')}.pdf"
     
     return FileResponse(
@@ -336,17 +421,11 @@ async def download_report(
 async def get_image(
     image_type: str,
     analysis_id: int,
-    doctor_id: int = Depends(verify_token),
+    doctor_id: int = Depends(get_current_doctor_id),
     db: Session = Depends(get_db)
 ):
     """Get original or Grad-CAM image"""
-    analysis = db.query(Analysis).filter(
-        Analysis.id == analysis_id,
-        Analysis.doctor_id == doctor_id
-    ).first()
-    
-    if not analysis:
-        raise HTTPException(status_code=404, detail="Analysis not found")
+    analysis = get_owned_analysis(db, analysis_id, doctor_id)
     
     image_path = analysis.image_path if image_type == "original" else analysis.gradcam_path
     
@@ -358,23 +437,33 @@ async def get_image(
 
 @app.get("/api/stats")
 async def get_statistics(
-    doctor_id: int = Depends(verify_token),
+    request: Request,
+    response: Response,
+    doctor_id: int = Depends(get_current_doctor_id),
     db: Session = Depends(get_db)
 ):
     """Get statistics for dashboard"""
-    total_analyses = db.query(Analysis).filter(Analysis.doctor_id == doctor_id).count()
+    etag = analyses_etag(db, doctor_id)
+    if etag_matches(request, etag):
+        not_modified = Response(status_code=status.HTTP_304_NOT_MODIFIED)
+        set_cache_headers(not_modified, etag)
+        return not_modified
     
     # Disease distribution
-    diseases = db.query(Analysis.disease).filter(Analysis.doctor_id == doctor_id).all()
-    disease_count = {}
-    for (disease,) in diseases:
-        disease_count[disease] = disease_count.get(disease, 0) + 1
+    rows = (
+        db.query(Analysis.disease, func.count())
+        .filter(Analysis.doctor_id == doctor_id)
+        .group_by(Analysis.disease)
+        .all()
+    )
+    disease_count = dict(rows)
     
-    # Recent analyses
-    recent = db.query(Analysis).filter(Analysis.doctor_id == doctor_id).order_by(Analysis.timestamp.desc()).limit(5).all()
+    # Total and recent count (last 5) follow from the distribution
+    total_analyses = sum(disease_count.values())
     
+    set_cache_headers(response, etag)
     return {
         "total_analyses": total_analyses,
         "disease_distribution": disease_count,
-        "recent_count": len(recent)
+        "recent_count": min(total_analyses, 5)
     }
\ No newline at end of file
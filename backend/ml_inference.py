@@ -3,31 +3,309 @@ Machine Learning Inference and Grad-CAM Generation
 """
 
 from fastai.vision.all import *
+import asyncio
+import bisect
+import os
+import random
+import threading
 import torch
 import torch.nn.functional as F
+from torchvision.io import ImageReadMode, decode_image, decode_jpeg, read_file
+from torchvision.transforms import v2
+from torchvision.transforms.v2.functional import pil_to_tensor
+from PIL import Image as PILImageModule
 import numpy as np
 import cv2
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 import warnings
 warnings.filterwarnings('ignore')
 
 
+# JET colormap as a 256x3 RGB lookup table (index = heat value 0-255)
+_JET_RGB_LUT = cv2.cvtColor(
+    cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cv2.COLORMAP_JET),
+    cv2.COLOR_BGR2RGB
+).reshape(256, 3)
+
+# Largest batch the dynamic batcher forms (and TensorRT engines are built for)
+MAX_BATCH_SIZE = 16
+
+# Batch sizes with a captured CUDA graph; other sizes are padded up to the next one
+CUDA_GRAPH_BATCH_SIZES = (1, 2, 4, 8, 16)
+
+# Allowed difference between the torchvision and fastai preprocessing of the
+# sample image, in [0, 1] pixel units (resampling kernels differ slightly)
+PREPROCESS_MEAN_TOLERANCE = 0.01
+PREPROCESS_MAX_TOLERANCE = 0.1
+
+# Static INT8 quantization for the ONNX CPU provider, calibrated on sample
+# X-rays from INT8_CALIBRATION_DIR (unset: stay on FP32)
+INT8_CALIBRATION_IMAGES = 32
+INT8_MAX_PROB_DIFF = 0.05
+
+# Grad-CAM JPEGs are encoded and written off the request thread
+_ENCODE_POOL = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='jpeg-encode')
+JPEG_QUALITY = 85
+
+# Optional SIMD encoder (PyTurboJPEG); OpenCV's libjpeg is the fallback
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+except Exception:
+    _turbo_jpeg = None
+
+
+def _encode_jpeg(rgb: np.ndarray) -> bytes:
+    """Encode an HxWx3 RGB image as JPEG bytes"""
+    if _turbo_jpeg is not None:
+        return _turbo_jpeg.encode(rgb, quality=JPEG_QUALITY, pixel_format=TJPF_RGB)
+    
+    ok, buf = cv2.imencode('.jpg', cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR),
+                           [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buf.tobytes()
+
+
+def _write_jpeg(path: str, rgb: np.ndarray):
+    """Encode and write atomically, so readers never see a partial file"""
+    tmp_path = f"{path}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(_encode_jpeg(rgb))
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _save_gradcam(path: str, rgb: np.ndarray, fallback_path: str) -> str:
+    """Write a Grad-CAM overlay, returning its path (or fallback_path if the write fails)"""
+    try:
+        _write_jpeg(path, rgb)
+        return path
+    except Exception as e:
+        print(f"Grad-CAM write error: {e}")
+        return fallback_path
+
+
+# Severity by normalized confidence: at or above each threshold (sorted ascending)
+_SEV_THRESHOLDS: Tuple[float, ...] = (0.5, 0.75, 0.9)
+_SEV_LABELS: Tuple[str, ...] = ('Mild', 'Moderate', 'Severe')
+
+# Affected lung regions per disease
+_REGION_MAP: Dict[str, Tuple[str, ...]] = {
+    'Normal': (),
+    'Bacterial Pneumonia': ('Lower lobes bilateral', 'Right middle lobe'),
+    'Viral Pneumonia': ('Bilateral interstitial pattern', 'Perihilar region'),
+    'COVID-19': ('Bilateral peripheral', 'Lower lobes', 'Ground-glass opacities'),
+    'Tuberculosis': ('Upper lobes', 'Apical segments', 'Cavitary lesions')
+}
+
+# Clinical recommendations per disease (severity-specific ones are prepended)
+_NORMAL_RECS: Tuple[str, ...] = ('No immediate treatment required', 'Continue routine health monitoring')
+_BASE_RECS: Dict[str, Tuple[str, ...]] = {
+    'Bacterial Pneumonia': (
+        'Initiate broad-spectrum antibiotic therapy',
+        'Monitor oxygen saturation continuously',
+        'Chest physiotherapy',
+        'Follow-up X-ray in 48-72 hours'
+    ),
+    'Viral Pneumonia': (
+        'Supportive care and hydration',
+        'Antiviral therapy if indicated',
+        'Monitor for secondary bacterial infection',
+        'Consider oxygen therapy'
+    ),
+    'COVID-19': (
+        'Isolate patient immediately',
+        'PCR test confirmation required',
+        'Monitor oxygen levels closely',
+        'Consider corticosteroids if severe',
+        'Thromboprophylaxis assessment'
+    ),
+    'Tuberculosis': (
+        'Initiate standard TB treatment regimen',
+        'Airborne isolation precautions',
+        'Contact tracing required',
+        'Sputum culture and sensitivity',
+        'Directly observed therapy (DOT)'
+    )
+}
+
+@lru_cache(maxsize=64)
+def _demo_heatmap_small(height: int, width: int) -> np.ndarray:
+    """Blurred 128x128 uint8 demo heatmap for an image size (16 KB, so caching is cheap)"""
+    # Filled circle in center-lower region (typical for pneumonia), drawn
+    # directly at 128x128 as the ellipse it becomes after scaling
+    sx, sy = 128 / width, 128 / height
+    radius = min(width, height) // 3
+    scale = 1 << 4  # cv2 subpixel shift
+    heatmap = cv2.ellipse(
+        np.zeros((128, 128), dtype=np.float32),
+        (round(((width // 2 + 0.5) * sx - 0.5) * scale),
+         round(((int(height * 0.6) + 0.5) * sy - 0.5) * scale)),
+        (round(radius * sx * scale), round(radius * sy * scale)),
+        0, 0, 360, 1.0, -1, cv2.LINE_AA, 4
+    )
+    
+    # Apply Gaussian blur at low resolution; the upsample keeps it smooth
+    heatmap = cv2.GaussianBlur(heatmap, (11, 11), 0)
+    
+    # Normalize to 0-255 for the colormap lookup
+    heatmap = (np.clip(heatmap, 0, 1) * 255).astype(np.uint8)
+    heatmap.setflags(write=False)
+    return heatmap
+
+
+def _sample_image() -> np.ndarray:
+    """Deterministic 1024x900 RGB test pattern: smooth structure plus film-grain noise"""
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:1024, 0:900]
+    gray = 127 + 60 * np.sin(xx / 37.0) * np.cos(yy / 53.0) + rng.normal(0, 25, xx.shape)
+    return np.repeat(np.clip(gray, 0, 255).astype(np.uint8)[..., None], 3, axis=2)
+
+
+class ImageDecodeError(ValueError):
+    """Uploaded file could not be decoded as an image by any decoder"""
+
+
+class DynamicBatcher:
+    """
+    Collect concurrent single-image requests into batched forward passes
+    
+    A batch is flushed once it holds max_batch images or its first image has
+    waited max_wait_ms. Batches run one at a time in a worker thread, so the
+    event loop stays free and requests arriving meanwhile form the next batch.
+    """
+    
+    def __init__(self, infer_fn: Callable, max_batch: int = 16, max_wait_ms: float = 20):
+        self.infer_fn = infer_fn  # NxCxHxW tensor -> N rows of output
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+    
+    async def submit(self, x: torch.Tensor):
+        """Queue one CxHxW tensor and wait for its row of the batched output"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((x, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            inputs, futures = zip(*batch)
+            try:
+                outputs = await asyncio.to_thread(self.infer_fn, torch.stack(inputs))
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for future, output in zip(futures, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+
 class ModelInference:
-    def __init__(self, model_path: str):
-        """Initialize the FastAI model"""
+    def __init__(self, model_path: str, backend: str = 'torch'):
+        """Initialize the FastAI model (backend: 'torch' or 'onnx')"""
         self.model_path = model_path
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         
-        # Load model
+        # Load model (onto the GPU when one is available)
         try:
-            self.learner = load_learner(model_path)
+            self.learner = load_learner(model_path, cpu=self.device.type == 'cpu')
             self.learner.model.eval()
             print(f"Model loaded successfully from {model_path}")
         except Exception as e:
             print(f"Error loading model: {e}")
             self.learner = None
         
+        # fastai CNN learners are Sequential(body, head). The body holds nearly all
+        # the compute and is what gets optimized below; the small head runs eagerly
+        # in FP32 on the body's activations, so Grad-CAM comes from the same pass.
+        self.model = None
+        self.head = None
+        if self.learner is not None:
+            model = self.learner.model
+            if isinstance(model, torch.nn.Sequential) and len(model) == 2:
+                self.model, self.head = model[0], model[1]
+            else:
+                self.model = model
+        self.memory_format = torch.contiguous_format
+        self.autocast_dtype = None
+        
+        # GPU tuning: TF32 matmuls/convs, cuDNN autotuning, NHWC weights,
+        # half-precision autocast (BF16 where supported for its wider range)
+        if self.model is not None and self.device.type == 'cuda':
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.backends.cudnn.benchmark = True
+            self.memory_format = torch.channels_last
+            self.model = self.model.to(memory_format=self.memory_format)
+            self.autocast_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        
+        # On-device preprocessing matching the learner's Resize/Normalize. Pipelines
+        # it can't reproduce, or that give different inputs on the sample image,
+        # run through the learner's own transforms like learner.predict
+        self.transforms = None
+        self._fastai_lock = threading.Lock()
+        if self.learner is not None:
+            self.transforms = self._build_transforms()
+            if self.transforms is not None and not self._transforms_match_fastai():
+                print("torchvision preprocessing differs from the learner's, using fastai transforms")
+                self.transforms = None
+        
+        # Optional ONNX Runtime session (TensorRT / CUDA / CPU providers)
+        self.ort_session = None
+        if self.learner is not None and backend == 'onnx':
+            self.ort_session = self._build_onnx_session()
+        
+        # GPU providers read/write CUDA memory directly through IOBinding
+        self.ort_on_cuda = (
+            self.ort_session is not None and self.device.type == 'cuda'
+            and self.ort_session.get_providers()[0] in ('TensorrtExecutionProvider', 'CUDAExecutionProvider')
+        )
+        
+        # TorchScript: fold Conv+BN, drop dropout, pick fused kernels
+        if self.learner is not None and self.ort_session is None:
+            self._optimize_for_inference()
+        
+        # Batches concurrent predict_async() calls into one forward pass
+        self.batcher = DynamicBatcher(self._infer_batch, max_batch=MAX_BATCH_SIZE, max_wait_ms=20)
+        
+        # CUDA graphs keyed by batch size: (graph, static input, static output)
+        self._cuda_graphs: Dict[int, tuple] = {}
+        self._graph_lock = threading.Lock()
+        
+        if self.learner is not None:
+            self._warmup()
+        
+        if self.learner is not None and self.ort_session is None and self.device.type == 'cuda':
+            self._capture_cuda_graphs()
+        
         # Disease classes (adjust based on your model)
         self.disease_classes = [
             'Normal',
@@ -37,12 +315,11 @@ class ModelInference:
             'Tuberculosis'
         ]
         
-        # Severity thresholds (you can adjust these)
-        self.severity_thresholds = {
-            'mild': 0.5,
-            'moderate': 0.75,
-            'severe': 0.9
-        }
+        # Private generator for mock predictions
+        self._rng = random.Random()
+        
+        # Colormap on the inference device for Grad-CAM overlays
+        self._jet_lut = torch.from_numpy(_JET_RGB_LUT).to(self.device)
     
     def predict(self, image_path: str) -> Dict:
         """
@@ -54,166 +331,512 @@ class ModelInference:
             return self._mock_prediction(image_path)
         
         try:
-            # Load and predict
-            img = PILImage.create(image_path)
-            pred_class, pred_idx, probs = self.learner.predict(img)
+            image, xb = self._load_image(image_path)
+            probs, cam = self._infer_batch(xb)[0]
+            prediction = self._build_prediction(probs)
+            prediction['gradcam_path'] = self._generate_gradcam(image_path, image, cam).result()
+            return prediction
+        
+        except ImageDecodeError:
+            # Not an image: a mock result must not be stored as a diagnosis
+            raise
+        except Exception as e:
+            print(f"Prediction error: {e}")
+            return self._mock_prediction(image_path)
+    
+    async def predict_async(self, image_path: str) -> Dict:
+        """
+        Perform prediction through the dynamic batcher
+        Returns: Same dictionary as predict()
+        Unlike predict(), inference errors are raised instead of mocked
+        """
+        if self.learner is None:
+            return self._mock_prediction(image_path)
+        
+        try:
+            image, xb = await asyncio.to_thread(self._load_image, image_path)
+            probs, cam = await self.batcher.submit(xb[0])
+            prediction = self._build_prediction(probs)
             
-            # Get disease and confidence
-            disease = str(pred_class)
-            confidence = float(probs[pred_idx]) * 100
+            # The overlay is built in a worker thread, then the JPEG write is
+            # awaited so the returned path exists when the client asks for it
+            write = await asyncio.to_thread(self._generate_gradcam, image_path, image, cam)
+            prediction['gradcam_path'] = await asyncio.wrap_future(write)
+            return prediction
+        
+        except ImageDecodeError:
+            # Not an image: a mock result must not be stored as a diagnosis
+            raise
+        except Exception as e:
+            # A failed forward fails every request in its batch; mocking them
+            # would store a random diagnosis for each of those patients
+            print(f"Prediction error: {e}")
+            raise
+    
+    def _build_prediction(self, probs: np.ndarray) -> Dict:
+        """Turn class probabilities for one image into the prediction dictionary (without gradcam_path)"""
+        # Get disease and confidence
+        pred_idx = int(probs.argmax())
+        disease = str(self.learner.dls.vocab[pred_idx])
+        confidence = float(probs[pred_idx]) * 100
+        
+        # Determine severity based on confidence and disease
+        severity = self._calculate_severity(disease, confidence)
+        
+        # Get affected regions
+        affected_regions = self._identify_regions(disease)
+        
+        # Generate recommendations
+        recommendations = self._generate_recommendations(disease, severity)
+        
+        return {
+            'disease': disease,
+            'severity': severity,
+            'confidence': confidence,
+            'affected_regions': affected_regions,
+            'recommendations': recommendations
+        }
+    
+    def _load_image(self, image_path: str) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Decode an image file once on the inference device
+        Returns: (CxHxW uint8 RGB image, preprocessed 1xCxHxW batch)
+        """
+        data = read_file(image_path)
+        image = None
+        if self.device.type == 'cuda' and data[:2].tolist() == [0xFF, 0xD8]:
+            # JPEG: decode straight into GPU memory with nvJPEG (rejects e.g. CMYK)
+            try:
+                image = decode_jpeg(data, mode=ImageReadMode.RGB, device=self.device)
+            except Exception:
+                image = None
+        
+        if image is None:
+            try:
+                image = decode_image(data, mode=ImageReadMode.RGB)
+            except Exception:
+                image = self._decode_with_pil(image_path)
+            image = image.to(self.device)
+        
+        return image, self._preprocess(image)
+    
+    def _decode_with_pil(self, image_path: str) -> torch.Tensor:
+        """Decode formats torchvision can't (BMP, TIFF, ...) into a CxHxW uint8 RGB tensor"""
+        try:
+            with PILImageModule.open(image_path) as img:
+                return pil_to_tensor(img.convert('RGB'))
+        except Exception as e:
+            raise ImageDecodeError(f"Could not decode image: {e}") from e
+    
+    def _infer_batch(self, xb: torch.Tensor) -> List[Tuple[np.ndarray, Optional[torch.Tensor]]]:
+        """
+        Run a preprocessed NxCxHxW batch through the model
+        Returns: per image, (K class probabilities, 1xhxw Grad-CAM map on the device or None)
+        """
+        out = self._run_model(xb)
+        if self.head is None:
+            probs = torch.softmax(out.float(), dim=1).cpu().numpy()
+            return [(row, None) for row in probs]
+        return self._classify_features(out)
+    
+    def _run_model(self, xb: torch.Tensor) -> torch.Tensor:
+        """Body activations (logits for models without a body/head split) for a batch"""
+        if self.ort_on_cuda:
+            return self._run_onnx_cuda(xb)
+        
+        if self.ort_session is not None:
+            out = self.ort_session.run(None, {'input': xb.cpu().numpy()})[0]
+            return torch.from_numpy(out).to(self.device)
+        
+        xb = xb.to(self.device, memory_format=self.memory_format)
+        n = xb.shape[0]
+        size = next((captured for captured in sorted(self._cuda_graphs) if captured >= n), None)
+        if size is not None:
+            graph, static_in, static_out = self._cuda_graphs[size]
+            if static_in.shape[1:] == xb.shape[1:]:
+                # Replays share static buffers, so requests take turns
+                with self._graph_lock:
+                    static_in[:n].copy_(xb)
+                    graph.replay()
+                    return static_out[:n].clone()
+        
+        return self._forward(xb)
+    
+    def _classify_features(self, acts: torch.Tensor) -> List[Tuple[np.ndarray, torch.Tensor]]:
+        """Run the head on body activations, with Grad-CAM for each predicted class from the same pass"""
+        # Copy out of inference mode (and up to FP32) so autograd can track it
+        acts = acts.to(torch.float32, copy=True).requires_grad_(True)
+        with torch.enable_grad():
+            logits = self.head(acts)
+            pred = logits.argmax(dim=1, keepdim=True)
+            # Images in a batch are independent, so one backward gives every image's gradient
+            grads, = torch.autograd.grad(logits.gather(1, pred).sum(), acts)
+        
+        # Grad-CAM: weight each channel by its spatially averaged gradient
+        weights = grads.mean(dim=(2, 3), keepdim=True)
+        cams = F.relu((weights * acts.detach()).sum(dim=1, keepdim=True))
+        probs = torch.softmax(logits.detach(), dim=1).cpu().numpy()
+        return list(zip(probs, cams))
+    
+    def _run_onnx_cuda(self, xb: torch.Tensor) -> torch.Tensor:
+        """Run ONNX Runtime on CUDA tensors via IOBinding, so input and output stay on the GPU"""
+        xb = xb.to(self.device, dtype=torch.float32, memory_format=torch.contiguous_format)
+        out = torch.empty((xb.shape[0], *self._onnx_output_shape), dtype=torch.float32, device=self.device)
+        device_id = self.device.index or 0
+        
+        binding = self.ort_session.io_binding()
+        binding.bind_input('input', 'cuda', device_id, np.float32, tuple(xb.shape), xb.data_ptr())
+        binding.bind_output(self._onnx_output_name, 'cuda', device_id, np.float32, tuple(out.shape), out.data_ptr())
+        
+        # ORT runs on its own stream; preprocessing must have finished writing xb
+        torch.cuda.current_stream(self.device).synchronize()
+        self.ort_session.run_with_iobinding(binding)
+        return out
+    
+    def _forward(self, xb: torch.Tensor) -> torch.Tensor:
+        """Eager (or TorchScript) forward pass of self.model"""
+        with torch.inference_mode(), torch.autocast(self.device.type, dtype=self.autocast_dtype,
+                                                    enabled=self.autocast_dtype is not None):
+            return self.model(xb)
+    
+    def _build_transforms(self) -> Optional[v2.Compose]:
+        """
+        Mirror the learner's Resize and Normalize steps with torchvision transforms
+        Returns None for steps this can't reproduce (batch-level resizing as in
+        presizing, RandomResizedCrop, pad resizing, non-square crops, ...)
+        """
+        dl = self.learner.dls.valid
+        resize = None
+        for tfm in dl.after_item.fs:
+            if isinstance(tfm, ToTensor):
+                continue
+            if isinstance(tfm, Resize) and resize is None:
+                size = (tfm.size[1], tfm.size[0])  # fastai stores (width, height)
+                if tfm.method == ResizeMethod.Squish:
+                    resize = [v2.Resize(size, antialias=True)]
+                    continue
+                if tfm.method == ResizeMethod.Crop and size[0] == size[1]:
+                    resize = [v2.Resize(size[0], antialias=True), v2.CenterCrop(size)]
+                    continue
+            print(f"Item transform {type(tfm).__name__} not supported on-device, using fastai transforms")
+            return None
+        
+        steps = [v2.ToDtype(torch.float32, scale=True)]
+        to_float = False
+        for tfm in dl.after_batch.fs:
+            if isinstance(tfm, IntToFloatTensor) and tfm.div == 255:
+                to_float = True
+            elif isinstance(tfm, Normalize):
+                steps.append(v2.Normalize(tfm.mean.flatten().tolist(), tfm.std.flatten().tolist()))
+            elif getattr(tfm, 'split_idx', None) != 0:  # split_idx 0: training-only augmentation
+                print(f"Batch transform {type(tfm).__name__} not supported on-device, using fastai transforms")
+                return None
+        
+        if resize is None or not to_float:
+            print("Learner has no item Resize or byte-to-float step, using fastai transforms")
+            return None
+        return v2.Compose(resize + steps)
+    
+    def _transforms_match_fastai(self) -> bool:
+        """Check the torchvision preprocessing against the learner's own on the sample image"""
+        try:
+            sample = torch.from_numpy(_sample_image()).permute(2, 0, 1)
+            ours = self.transforms(sample.to(self.device)).unsqueeze(0).cpu()
+            expected = self._preprocess_fastai(sample).cpu()
+            if ours.shape != expected.shape:
+                print(f"Preprocessed shape {tuple(ours.shape)} != fastai's {tuple(expected.shape)}")
+                return False
+            
+            # Compare in pixel units, so the tolerance doesn't depend on Normalize's std
+            std = next((t.std for t in self.transforms.transforms if isinstance(t, v2.Normalize)), [1.0])
+            diff = (ours - expected).abs() * torch.tensor(std).view(-1, 1, 1)
+            return (diff.mean().item() <= PREPROCESS_MEAN_TOLERANCE
+                    and diff.max().item() <= PREPROCESS_MAX_TOLERANCE)
+        except Exception as e:
+            print(f"Preprocessing check failed: {e}")
+            return False
+    
+    def _preprocess(self, image: torch.Tensor) -> torch.Tensor:
+        """Transform a CxHxW uint8 RGB image into a normalized 1xCxHxW batch"""
+        if self.transforms is None:
+            return self._preprocess_fastai(image).to(self.device)
+        return self.transforms(image).unsqueeze(0)
+    
+    def _preprocess_fastai(self, image: torch.Tensor) -> torch.Tensor:
+        """Run the learner's item and batch transforms (as learner.predict does) on a CxHxW uint8 image"""
+        img = PILImage.create(image.permute(1, 2, 0).cpu().numpy())
+        # fastai transforms keep per-call state on the shared transform objects
+        with self._fastai_lock:
+            xb = self.learner.dls.test_dl([img], num_workers=0).one_batch()[0]
+        return xb.as_subclass(torch.Tensor)
+    
+    def _dummy_batch(self) -> torch.Tensor:
+        """Blank image preprocessed to the model's expected input shape"""
+        return self._preprocess(torch.zeros((3, 512, 512), dtype=torch.uint8, device=self.device))
+    
+    def _optimize_for_inference(self):
+        """Freeze the body (or whole model) with torch.jit, keeping the eager module on failure"""
+        try:
+            try:
+                scripted = torch.jit.script(self.model)
+            except Exception:
+                # Not every fastai layer is scriptable; the input shape is fixed, so tracing is exact
+                with torch.no_grad():
+                    example = self._dummy_batch().to(memory_format=self.memory_format)
+                    scripted = torch.jit.trace(self.model, example)
+            self.model = torch.jit.optimize_for_inference(scripted)
+        except Exception as e:
+            print(f"TorchScript optimization failed, using eager model: {e}")
+    
+    def _warmup(self, runs: int = 3):
+        """Run dummy batches so autotuning and JIT fusion happen before the first request"""
+        try:
+            dummy = self._dummy_batch()
+            for _ in range(runs):
+                self._infer_batch(dummy)
+        except Exception as e:
+            print(f"Warmup failed: {e}")
+    
+    def _capture_cuda_graphs(self):
+        """Capture the forward pass once per batch size so requests replay it without kernel launches"""
+        try:
+            example = self._dummy_batch().to(memory_format=self.memory_format)
+            pool = torch.cuda.graph_pool_handle()
+            stream = torch.cuda.Stream()
+            graphs = {}
             
-            # Determine severity based on confidence and disease
-            severity = self._calculate_severity(disease, confidence)
+            # Largest first, so smaller graphs fit in the shared memory pool
+            for size in sorted(CUDA_GRAPH_BATCH_SIZES, reverse=True):
+                static_in = example.expand(size, -1, -1, -1).clone(memory_format=self.memory_format)
+                
+                # Capture must not trigger cuDNN autotuning, so run this shape once first
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    self._forward(static_in)
+                torch.cuda.current_stream().wait_stream(stream)
+                
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph, pool=pool):
+                    static_out = self._forward(static_in)
+                graphs[size] = (graph, static_in, static_out)
             
-            # Generate Grad-CAM
-            gradcam_path = self._generate_gradcam(image_path, pred_idx)
+            self._cuda_graphs = graphs
+            print(f"Captured CUDA graphs for batch sizes {sorted(graphs)}")
+        except Exception as e:
+            print(f"CUDA graph capture failed, using regular launches: {e}")
+            self._cuda_graphs = {}
+    
+    def _build_onnx_session(self):
+        """Export the model to ONNX and load it with ONNX Runtime"""
+        try:
+            import onnxruntime as ort
             
-            # Get affected regions
-            affected_regions = self._identify_regions(disease)
+            # Only the body is exported when the head runs in PyTorch for Grad-CAM
+            if self.head is not None:
+                onnx_path = Path(self.model_path).with_suffix('.body.onnx')
+                self._onnx_output_name = 'features'
+            else:
+                onnx_path = Path(self.model_path).with_suffix('.onnx')
+                self._onnx_output_name = 'logits'
+            with torch.no_grad():
+                self._onnx_output_shape = tuple(self.model(self._dummy_batch()).shape[1:])
             
-            # Generate recommendations
-            recommendations = self._generate_recommendations(disease, severity)
+            # Re-export only when the learner file is newer than the ONNX graph
+            if not onnx_path.exists() or onnx_path.stat().st_mtime < Path(self.model_path).stat().st_mtime:
+                torch.onnx.export(
+                    self.model, self._dummy_batch(), str(onnx_path),
+                    input_names=['input'], output_names=[self._onnx_output_name],
+                    opset_version=17,
+                    dynamic_axes={'input': {0: 'batch'}, self._onnx_output_name: {0: 'batch'}}
+                )
             
-            return {
-                'disease': disease,
-                'severity': severity,
-                'confidence': confidence,
-                'affected_regions': affected_regions,
-                'recommendations': recommendations,
-                'gradcam_path': gradcam_path
-            }
+            # Prefer TensorRT (FP16, cached engines), then CUDA, then CPU.
+            # The TensorRT profile spans every batch size the batcher can send,
+            # so a new size never triggers an engine rebuild mid-request.
+            channels, height, width = self._dummy_batch().shape[1:]
+            shape = f"{channels}x{height}x{width}"
+            available = ort.get_available_providers()
+            providers = []
+            if 'TensorrtExecutionProvider' in available:
+                providers.append(('TensorrtExecutionProvider', {
+                    'trt_fp16_enable': True,
+                    'trt_engine_cache_enable': True,
+                    'trt_engine_cache_path': str(onnx_path.parent),
+                    'trt_profile_min_shapes': f"input:1x{shape}",
+                    'trt_profile_opt_shapes': f"input:{MAX_BATCH_SIZE}x{shape}",
+                    'trt_profile_max_shapes': f"input:{MAX_BATCH_SIZE}x{shape}",
+                }))
+            if 'CUDAExecutionProvider' in available:
+                providers.append('CUDAExecutionProvider')
+            providers.append('CPUExecutionProvider')
+            
+            # Without a GPU provider, an INT8 graph is several times faster on CPU
+            session = None
+            if providers == ['CPUExecutionProvider']:
+                session = self._build_int8_session(ort, onnx_path)
+            if session is None:
+                session = ort.InferenceSession(str(onnx_path), providers=providers)
+            print(f"ONNX Runtime session ready ({session.get_providers()[0]})")
+            return session
+        except Exception as e:
+            print(f"ONNX Runtime unavailable, using PyTorch inference: {e}")
+            return None
+    
+    def _build_int8_session(self, ort, onnx_path: Path):
+        """
+        Quantize the exported graph to static INT8 (QDQ) for the CPU provider
+        Calibrates on images from INT8_CALIBRATION_DIR and keeps the INT8 graph
+        only if it gives the same predictions as FP32 on them. The quantized graph
+        is cached next to the FP32 one; delete it to recalibrate.
+        Returns: INT8 InferenceSession, or None to stay on FP32
+        """
+        calibration_dir = os.getenv('INT8_CALIBRATION_DIR')
+        if not calibration_dir:
+            return None
         
+        try:
+            from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+            from onnxruntime.quantization.shape_inference import quant_pre_process
+            
+            batches = []
+            for path in sorted(Path(calibration_dir).iterdir()):
+                if len(batches) == INT8_CALIBRATION_IMAGES:
+                    break
+                try:
+                    batches.append(self._load_image(str(path))[1].cpu().numpy())
+                except (ImageDecodeError, IsADirectoryError):
+                    continue
+            if not batches:
+                print(f"No calibration images in {calibration_dir}, keeping FP32")
+                return None
+            
+            int8_path = onnx_path.with_suffix('.int8.onnx')
+            if not int8_path.exists() or int8_path.stat().st_mtime < onnx_path.stat().st_mtime:
+                samples = iter([{'input': xb} for xb in batches])
+                
+                class _CalibrationReader(CalibrationDataReader):
+                    def get_next(self):
+                        return next(samples, None)
+                
+                # Shape inference and graph cleanup first, as ORT recommends for static quantization
+                prepared_path = onnx_path.with_suffix('.prep.onnx')
+                quant_pre_process(str(onnx_path), str(prepared_path))
+                try:
+                    quantize_static(
+                        str(prepared_path), str(int8_path), _CalibrationReader(),
+                        quant_format=QuantFormat.QDQ, per_channel=True,
+                        weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8
+                    )
+                finally:
+                    prepared_path.unlink(missing_ok=True)
+            
+            # Compare diagnoses with the FP32 graph on the calibration images
+            xb = np.concatenate(batches)
+            fp32 = ort.InferenceSession(str(onnx_path), providers=['CPUExecutionProvider'])
+            session = ort.InferenceSession(str(int8_path), providers=['CPUExecutionProvider'])
+            expected = self._output_probs(fp32.run(None, {'input': xb})[0])
+            actual = self._output_probs(session.run(None, {'input': xb})[0])
+            if ((expected.argmax(axis=1) != actual.argmax(axis=1)).any()
+                    or np.abs(expected - actual).max() > INT8_MAX_PROB_DIFF):
+                print("INT8 predictions differ from FP32 on the calibration images, keeping FP32")
+                return None
+            
+            print(f"Using INT8 ONNX graph calibrated on {len(batches)} images")
+            return session
         except Exception as e:
-            print(f"Prediction error: {e}")
-            return self._mock_prediction(image_path)
+            print(f"INT8 quantization failed, keeping FP32: {e}")
+            return None
+    
+    def _output_probs(self, out: np.ndarray) -> np.ndarray:
+        """Class probabilities for ONNX outputs (body features are run through the head)"""
+        with torch.inference_mode():
+            logits = torch.from_numpy(out).to(self.device)
+            if self.head is not None:
+                logits = self.head(logits)
+            return torch.softmax(logits.float(), dim=1).cpu().numpy()
     
     def _calculate_severity(self, disease: str, confidence: float) -> str:
         """Calculate severity based on disease type and confidence"""
         if disease == 'Normal':
             return 'None'
         
-        # Normalize confidence to 0-1 range
-        conf_normalized = confidence / 100.0
-        
-        if conf_normalized >= self.severity_thresholds['severe']:
-            return 'Severe'
-        elif conf_normalized >= self.severity_thresholds['moderate']:
-            return 'Moderate'
-        else:
-            return 'Mild'
+        # Normalize confidence to 0-1 range; below the lowest threshold is still Mild
+        idx = bisect.bisect_right(_SEV_THRESHOLDS, confidence / 100.0) - 1
+        return _SEV_LABELS[max(idx, 0)]
     
-    def _generate_gradcam(self, image_path: str, target_class: int) -> str:
-        """Generate Grad-CAM heatmap"""
+    def _generate_gradcam(self, image_path: str, image: torch.Tensor, cam: Optional[torch.Tensor]) -> Future:
+        """
+        Generate Grad-CAM heatmap (demo heatmap when Grad-CAM is unavailable)
+        image is the CxHxW uint8 RGB tensor already decoded by _load_image,
+        cam the 1xhxw map computed alongside the prediction.
+        Returns: Future resolving to the written Grad-CAM path, or image_path on failure
+        """
         try:
-            # Load image
-            img = cv2.imread(image_path)
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            
-            # For demonstration, create a simple heatmap
-            # In production, implement proper Grad-CAM
-            heatmap = self._create_demo_heatmap(img)
-            
-            # Overlay heatmap on original image
-            overlay = cv2.addWeighted(img, 0.6, heatmap, 0.4, 0)
+            if cam is not None:
+                overlay = self._overlay_cam(image, cam)
+            else:
+                img = image.permute(1, 2, 0).contiguous().cpu().numpy()
+                heatmap = self._create_demo_heatmap(img)
+                # Overlay heatmap on original image (in place, img is our own copy)
+                overlay = cv2.addWeighted(img, 0.6, heatmap, 0.4, 0, dst=img)
             
             # Save Grad-CAM image
             gradcam_filename = f"gradcam_{Path(image_path).stem}.jpg"
             gradcam_path = f"uploads/{gradcam_filename}"
-            cv2.imwrite(gradcam_path, cv2.cvtColor(overlay, cv2.COLOR_RGB2BGR))
-            
-            return gradcam_path
+            return _ENCODE_POOL.submit(_save_gradcam, gradcam_path, overlay, image_path)
         
         except Exception as e:
             print(f"Grad-CAM generation error: {e}")
-            return image_path  # Return original if Grad-CAM fails
+            # Return original if Grad-CAM fails
+            failed = Future()
+            failed.set_result(image_path)
+            return failed
+    
+    def _overlay_cam(self, image: torch.Tensor, cam: torch.Tensor) -> np.ndarray:
+        """Upsample, colorize and blend a Grad-CAM map onto a CxHxW RGB image on the device"""
+        height, width = image.shape[1:]
+        cam = F.interpolate(cam[None].float(), size=(height, width), mode='bilinear', align_corners=False)[0, 0]
+        cam = cam / cam.max().clamp_min(1e-8)
+        heatmap = self._jet_lut[(cam * 255).round_().long()]
+        
+        overlay = image.permute(1, 2, 0).float().mul_(0.6).add_(heatmap.float(), alpha=0.4).round_()
+        return overlay.to(torch.uint8).contiguous().cpu().numpy()
     
     def _create_demo_heatmap(self, img: np.ndarray) -> np.ndarray:
         """Create demonstration heatmap (replace with real Grad-CAM)"""
         height, width = img.shape[:2]
         
-        # Create circular heatmap in center-lower region (typical for pneumonia)
-        y, x = np.ogrid[:height, :width]
-        center_x, center_y = width // 2, int(height * 0.6)
-        radius = min(width, height) // 3
-        
-        mask = (x - center_x)**2 + (y - center_y)**2 <= radius**2
-        
-        heatmap = np.zeros((height, width), dtype=np.float32)
-        heatmap[mask] = 1.0
-        
-        # Apply Gaussian blur
-        heatmap = cv2.GaussianBlur(heatmap, (51, 51), 0)
-        
-        # Normalize and convert to color
-        heatmap = (heatmap * 255).astype(np.uint8)
-        heatmap_color = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-        heatmap_color = cv2.cvtColor(heatmap_color, cv2.COLOR_BGR2RGB)
-        
-        return heatmap_color
+        # Upsample the cached low-res heatmap, then convert to color
+        heatmap = cv2.resize(_demo_heatmap_small(height, width), (width, height),
+                             interpolation=cv2.INTER_LINEAR)
+        return _JET_RGB_LUT[heatmap]
     
     def _identify_regions(self, disease: str) -> List[str]:
         """Identify affected lung regions based on disease"""
-        region_map = {
-            'Normal': [],
-            'Bacterial Pneumonia': ['Lower lobes bilateral', 'Right middle lobe'],
-            'Viral Pneumonia': ['Bilateral interstitial pattern', 'Perihilar region'],
-            'COVID-19': ['Bilateral peripheral', 'Lower lobes', 'Ground-glass opacities'],
-            'Tuberculosis': ['Upper lobes', 'Apical segments', 'Cavitary lesions']
-        }
-        return region_map.get(disease, ['Bilateral lung fields'])
+        return list(_REGION_MAP.get(disease, ('Bilateral lung fields',)))
     
     def _generate_recommendations(self, disease: str, severity: str) -> List[str]:
         """Generate clinical recommendations"""
         if disease == 'Normal':
-            return ['No immediate treatment required', 'Continue routine health monitoring']
-        
-        base_recommendations = {
-            'Bacterial Pneumonia': [
-                'Initiate broad-spectrum antibiotic therapy',
-                'Monitor oxygen saturation continuously',
-                'Chest physiotherapy',
-                'Follow-up X-ray in 48-72 hours'
-            ],
-            'Viral Pneumonia': [
-                'Supportive care and hydration',
-                'Antiviral therapy if indicated',
-                'Monitor for secondary bacterial infection',
-                'Consider oxygen therapy'
-            ],
-            'COVID-19': [
-                'Isolate patient immediately',
-                'PCR test confirmation required',
-                'Monitor oxygen levels closely',
-                'Consider corticosteroids if severe',
-                'Thromboprophylaxis assessment'
-            ],
-            'Tuberculosis': [
-                'Initiate standard TB treatment regimen',
-                'Airborne isolation precautions',
-                'Contact tracing required',
-                'Sputum culture and sensitivity',
-                'Directly observed therapy (DOT)'
-            ]
-        }
+            return list(_NORMAL_RECS)
         
-        recommendations = base_recommendations.get(disease, ['Consult specialist'])
+        recommendations = _BASE_RECS.get(disease, ('Consult specialist',))
         
         # Add severity-specific recommendations
         if severity == 'Severe':
-            recommendations.insert(0, '⚠️ URGENT: Consider ICU admission')
-            recommendations.insert(1, 'Immediate specialist consultation required')
+            return ['⚠️ URGENT: Consider ICU admission',
+                    'Immediate specialist consultation required',
+                    *recommendations]
         elif severity == 'Moderate':
-            recommendations.insert(0, 'Hospital admission recommended')
+            return ['Hospital admission recommended', *recommendations]
         
-        return recommendations
+        return list(recommendations)
     
     def _mock_prediction(self, image_path: str) -> Dict:
         """Mock prediction for demonstration when model isn't available"""
-        import random
-        
-        disease = random.choice(self.disease_classes[1:])  # Exclude Normal
-        confidence = random.uniform(75, 95)
-        severity = random.choice(['Mild', 'Moderate', 'Severe'])
+        disease = self._rng.choice(self.disease_classes[1:])  # Exclude Normal
+        confidence = self._rng.uniform(75, 95)
+        severity = self._rng.choice(_SEV_LABELS)
         
         return {
             'disease': disease,
@@ -222,4 +845,19 @@ class ModelInference:
             'affected_regions': self._identify_regions(disease),
             'recommendations': self._generate_recommendations(disease, severity),
             'gradcam_path': image_path
-        }
\ No newline at end of file
+        }
+
+
+# One ModelInference per process, created on first use (the app's lifespan hook)
+_INSTANCE: Optional[ModelInference] = None
+_INSTANCE_LOCK = threading.Lock()
+
+
+def get_model_inference(model_path: str, backend: str = 'torch') -> ModelInference:
+    """Return the process-wide ModelInference, loading the model on the first call"""
+    global _INSTANCE
+    if _INSTANCE is None:
+        with _INSTANCE_LOCK:
+            if _INSTANCE is None:
+                _INSTANCE = ModelInference(model_path, backend=backend)
+    return _INSTANCE
@@ -54,5 +54,7 @@ class AnalysisResponse(BaseModel):
     affected_regions: List[str]
     recommendations: List[str]
     gradcam_image: str
-    report_path: str
+    report_path: Optional[str] = None
+    report_status: str = "pending"  # report is rendered in the background
+    report_url: Optional[str] = None
     timestamp: str
\ No newline at end of file
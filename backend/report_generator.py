@@ -10,9 +10,133 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, Tabl
 from reportlab.lib.enums import TA_CENTER, TA_LEFT, TA_RIGHT
 from datetime import datetime
 from typing import Dict
+import copy
 import os
 
 
+# Styles and table styles are shared by every report; only the data changes
+_STYLES = getSampleStyleSheet()
+
+_TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=_STYLES['Heading1'],
+    fontSize=24,
+    textColor=colors.HexColor('#1e40af'),
+    spaceAfter=30,
+    alignment=TA_CENTER
+)
+
+_HEADING_STYLE = ParagraphStyle(
+    'CustomHeading',
+    parent=_STYLES['Heading2'],
+    fontSize=14,
+    textColor=colors.HexColor('#1e40af'),
+    spaceAfter=12,
+    spaceBefore=12
+)
+
+_DISCLAIMER_STYLE = ParagraphStyle(
+    'Disclaimer',
+    parent=_STYLES['Normal'],
+    fontSize=9,
+    textColor=colors.HexColor('#6b7280'),
+    borderWidth=1,
+    borderColor=colors.grey,
+    borderPadding=10,
+    backColor=colors.HexColor('#f9fafb')
+)
+
+_HEADER_TSTYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#e0e7ff')),
+    ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+    ('TOPPADDING', (0, 0), (-1, -1), 8),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey)
+])
+
+_PATIENT_TSTYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f3f4f6')),
+    ('BACKGROUND', (2, 0), (2, -1), colors.HexColor('#f3f4f6')),
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+    ('TOPPADDING', (0, 0), (-1, -1), 6),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey)
+])
+
+_VITAL_TSTYLE = TableStyle([
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+    ('TOPPADDING', (0, 0), (-1, -1), 4),
+])
+
+_RESULTS_TSTYLE_BASE = (
+    ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#e0e7ff')),
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
+    ('TOPPADDING', (0, 0), (-1, -1), 8),
+    ('GRID', (0, 0), (-1, -1), 1, colors.grey),
+)
+
+_SIGNATURE_TSTYLE = TableStyle([
+    ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, -1), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
+    ('TOPPADDING', (0, 0), (-1, -1), 6),
+    ('ALIGN', (0, 0), (-1, -1), 'LEFT')
+])
+
+# Color code based on severity
+_SEVERITY_COLORS = {
+    'Mild': colors.HexColor('#10b981'),
+    'Moderate': colors.HexColor('#f59e0b'),
+    'Severe': colors.HexColor('#ef4444'),
+    'None': colors.HexColor('#6b7280')
+}
+
+
+def _results_table_style(severity_color) -> TableStyle:
+    """Results table style with the severity cell highlighted"""
+    return TableStyle(list(_RESULTS_TSTYLE_BASE) + [
+        ('BACKGROUND', (1, 2), (1, 2), severity_color),
+        ('TEXTCOLOR', (1, 2), (1, 2), colors.white)
+    ])
+
+
+# One results style per severity, plus the fallback for unknown grades
+_RESULTS_TSTYLES = {severity: _results_table_style(color) for severity, color in _SEVERITY_COLORS.items()}
+_RESULTS_TSTYLE_DEFAULT = _results_table_style(colors.grey)
+
+_DISCLAIMER_TEXT = """
+<b>IMPORTANT DISCLAIMER:</b> This report has been generated with AI assistance and represents a preliminary analysis. 
+All findings must be reviewed and confirmed by a qualified radiologist or physician before making any clinical decisions. 
+This AI system is designed to assist healthcare professionals, not replace clinical judgment. 
+The final diagnosis and treatment plan should be determined by the attending physician based on complete clinical context.
+"""
+
+# Static text is parsed into Paragraphs once; each report gets shallow copies
+_TITLE = Paragraph("AI-ASSISTED CHEST X-RAY ANALYSIS REPORT", _TITLE_STYLE)
+_HEADINGS = {
+    text: Paragraph(text, _HEADING_STYLE)
+    for text in (
+        "PATIENT INFORMATION", "CLINICAL INDICATION", "VITAL SIGNS", "AI ANALYSIS RESULTS",
+        "FINDINGS", "IMPRESSION", "CLINICAL RECOMMENDATIONS"
+    )
+}
+_DISCLAIMER = Paragraph(_DISCLAIMER_TEXT, _DISCLAIMER_STYLE)
+
+
+def _heading(text: str) -> Paragraph:
+    """Copy of a pre-parsed section heading (layout state is per flowable)"""
+    return copy.copy(_HEADINGS[text])
+
+
 def generate_pdf_report(analysis, patient, doctor, prediction: Dict) -> str:
     """Generate comprehensive medical report as PDF"""
     
@@ -23,29 +147,9 @@ def generate_pdf_report(analysis, patient, doctor, prediction: Dict) -> str:
     # Create PDF document
     doc = SimpleDocTemplate(filename, pagesize=letter)
     story = []
-    styles = getSampleStyleSheet()
-    
-    # Custom styles
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        textColor=colors.HexColor('#1e40af'),
-        spaceAfter=30,
-        alignment=TA_CENTER
-    )
-    
-    heading_style = ParagraphStyle(
-        'CustomHeading',
-        parent=styles['Heading2'],
-        fontSize=14,
-        textColor=colors.HexColor('#1e40af'),
-        spaceAfter=12,
-        spaceBefore=12
-    )
     
     # Title
-    story.append(Paragraph("AI-ASSISTED CHEST X-RAY ANALYSIS REPORT", title_style))
+    story.append(copy.copy(_TITLE))
     story.append(Spacer(1, 0.2*inch))
     
     # Header information box
@@ -58,21 +162,12 @@ def generate_pdf_report(analysis, patient, doctor, prediction: Dict) -> str:
     ]
     
     header_table = Table(header_data, colWidths=[2*inch, 4*inch])
-    header_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#e0e7ff')),
-        ('TEXTCOLOR', (0, 0), (-1, -1), colors.black),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey)
-    ]))
+    header_table.setStyle(_HEADER_TSTYLE)
     story.append(header_table)
     story.append(Spacer(1, 0.3*inch))
     
     # Patient Information Section
-    story.append(Paragraph("PATIENT INFORMATION", heading_style))
+    story.append(_heading("PATIENT INFORMATION"))
     
     patient_data = [
         ['Name:', patient.name, 'Age:', f"{patient.age} years"],
@@ -80,32 +175,23 @@ def generate_pdf_report(analysis, patient, doctor, prediction: Dict) -> str:
     ]
     
     patient_table = Table(patient_data, colWidths=[1.2*inch, 2*inch, 1*inch, 1.8*inch])
-    patient_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#f3f4f6')),
-        ('BACKGROUND', (2, 0), (2, -1), colors.HexColor('#f3f4f6')),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTNAME', (2, 0), (2, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey)
-    ]))
+    patient_table.setStyle(_PATIENT_TSTYLE)
     story.append(patient_table)
     story.append(Spacer(1, 0.2*inch))
     
     # Clinical Indication
-    story.append(Paragraph("CLINICAL INDICATION", heading_style))
-    story.append(Paragraph(f"Symptoms: {analysis.symptoms}", styles['Normal']))
+    story.append(_heading("CLINICAL INDICATION"))
+    story.append(Paragraph(f"Symptoms: {analysis.symptoms}", _STYLES['Normal']))
     
     if patient.medical_history:
         story.append(Spacer(1, 0.1*inch))
-        story.append(Paragraph(f"Medical History: {patient.medical_history}", styles['Normal']))
+        story.append(Paragraph(f"Medical History: {patient.medical_history}", _STYLES['Normal']))
     
     story.append(Spacer(1, 0.2*inch))
     
     # Vital Signs
     if any([analysis.temperature, analysis.oxygen_saturation, analysis.heart_rate, analysis.respiratory_rate]):
-        story.append(Paragraph("VITAL SIGNS", heading_style))
+        story.append(_heading("VITAL SIGNS"))
         
         vital_data = []
         if analysis.temperature:
@@ -118,27 +204,12 @@ def generate_pdf_report(analysis, patient, doctor, prediction: Dict) -> str:
             vital_data.append(['Respiratory Rate:', f"{analysis.respiratory_rate} breaths/min"])
         
         vital_table = Table(vital_data, colWidths=[2.5*inch, 3.5*inch])
-        vital_table.setStyle(TableStyle([
-            ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-            ('FONTSIZE', (0, 0), (-1, -1), 10),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-            ('TOPPADDING', (0, 0), (-1, -1), 4),
-        ]))
+        vital_table.setStyle(_VITAL_TSTYLE)
         story.append(vital_table)
         story.append(Spacer(1, 0.2*inch))
     
     # AI Analysis Results
-    story.append(Paragraph("AI ANALYSIS RESULTS", heading_style))
-    
-    # Color code based on severity
-    severity_colors = {
-        'Mild': colors.HexColor('#10b981'),
-        'Moderate': colors.HexColor('#f59e0b'),
-        'Severe': colors.HexColor('#ef4444'),
-        'None': colors.HexColor('#6b7280')
-    }
-    
-    severity_color = severity_colors.get(prediction['severity'], colors.grey)
+    story.append(_heading("AI ANALYSIS RESULTS"))
     
     results_data = [
         ['Detected Condition:', prediction['disease']],
@@ -148,21 +219,12 @@ def generate_pdf_report(analysis, patient, doctor, prediction: Dict) -> str:
     ]
     
     results_table = Table(results_data, colWidths=[2.5*inch, 3.5*inch])
-    results_table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (0, -1), colors.HexColor('#e0e7ff')),
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 8),
-        ('TOPPADDING', (0, 0), (-1, -1), 8),
-        ('GRID', (0, 0), (-1, -1), 1, colors.grey),
-        ('BACKGROUND', (1, 2), (1, 2), severity_color),
-        ('TEXTCOLOR', (1, 2), (1, 2), colors.white)
-    ]))
+    results_table.setStyle(_RESULTS_TSTYLES.get(prediction['severity'], _RESULTS_TSTYLE_DEFAULT))
     story.append(results_table)
     story.append(Spacer(1, 0.3*inch))
     
     # Findings
-    story.append(Paragraph("FINDINGS", heading_style))
+    story.append(_heading("FINDINGS"))
     
     if prediction['disease'] != 'Normal':
         findings_text = f"""
@@ -173,44 +235,27 @@ def generate_pdf_report(analysis, patient, doctor, prediction: Dict) -> str:
     else:
         findings_text = "The chest X-ray demonstrates clear lung fields with no acute abnormalities detected. Cardiac silhouette is within normal limits."
     
-    story.append(Paragraph(findings_text.strip(), styles['Normal']))
+    story.append(Paragraph(findings_text.strip(), _STYLES['Normal']))
     story.append(Spacer(1, 0.3*inch))
     
     # Impression
-    story.append(Paragraph("IMPRESSION", heading_style))
+    story.append(_heading("IMPRESSION"))
     impression_text = f"{prediction['disease']} - {prediction['severity']} severity"
-    story.append(Paragraph(impression_text, styles['Normal']))
+    story.append(Paragraph(impression_text, _STYLES['Normal']))
     story.append(Spacer(1, 0.3*inch))
     
     # Recommendations
-    story.append(Paragraph("CLINICAL RECOMMENDATIONS", heading_style))
+    story.append(_heading("CLINICAL RECOMMENDATIONS"))
     
-    for i, rec in enumerate(prediction['recommendations'], 1):
-        story.append(Paragraph(f"{i}. {rec}", styles['Normal']))
-        story.append(Spacer(1, 0.05*inch))
+    recommendations_text = '<br/>'.join(
+        f"{i}. {rec}" for i, rec in enumerate(prediction['recommendations'], 1)
+    )
+    story.append(Paragraph(recommendations_text, _STYLES['Normal']))
     
     story.append(Spacer(1, 0.3*inch))
     
     # Disclaimer
-    disclaimer_style = ParagraphStyle(
-        'Disclaimer',
-        parent=styles['Normal'],
-        fontSize=9,
-        textColor=colors.HexColor('#6b7280'),
-        borderWidth=1,
-        borderColor=colors.grey,
-        borderPadding=10,
-        backColor=colors.HexColor('#f9fafb')
-    )
-    
-    disclaimer_text = """
-    <b>IMPORTANT DISCLAIMER:</b> This report has been generated with AI assistance and represents a preliminary analysis. 
-    All findings must be reviewed and confirmed by a qualified radiologist or physician before making any clinical decisions. 
-    This AI system is designed to assist healthcare professionals, not replace clinical judgment. 
-    The final diagnosis and treatment plan should be determined by the attending physician based on complete clinical context.
-    """
-    
-    story.append(Paragraph(disclaimer_text, disclaimer_style))
+    story.append(copy.copy(_DISCLAIMER))
     story.append(Spacer(1, 0.3*inch))
     
     # Signature section
@@ -220,13 +265,7 @@ def generate_pdf_report(analysis, patient, doctor, prediction: Dict) -> str:
     ]
     
     signature_table = Table(signature_data, colWidths=[2*inch, 4*inch])
-    signature_table.setStyle(TableStyle([
-        ('FONTNAME', (0, 0), (0, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, -1), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 6),
-        ('TOPPADDING', (0, 0), (-1, -1), 6),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT')
-    ]))
+    signature_table.setStyle(_SIGNATURE_TSTYLE)
     story.append(signature_table)
     
     # Build PDF
@@ -277,10 +277,14 @@ function displayResults(data) {
                 </ul>
                 
                 <div style="margin-top: 2rem; padding-top: 1.5rem; border-top: 1px solid var(--border-color);">
-                    <button class="btn btn-primary btn-block" onclick="downloadReport(${
+                    <button id="downloadReportBtn" class="btn btn-primary btn-block" onclick="downloadReport(${
                       data.analysis_id
-                    })">
-                        📄 Download PDF Report
+                    })" ${data.report_status === "pending" ? "disabled" : ""}>
+                        ${
+                          data.report_status === "pending"
+                            ? "⏳ Generating PDF Report..."
+                            : "📄 Download PDF Report"
+                        }
                     </button>
                 </div>
             </div>
@@ -301,22 +305,107 @@ function displayResults(data) {
 
   resultsSection.classList.remove("hidden");
   resultsSection.scrollIntoView({ behavior: "smooth", block: "start" });
+
+  if (data.report_status === "pending") {
+    pollReport(data.analysis_id, data.report_url);
+  }
 }
 
-// Download Report (Global function)
-window.downloadReport = async function (analysisId) {
-  try {
-    const response = await fetch(
-      `${API_URL}/api/download/report/${analysisId}`,
-      {
+// Reports are rendered in the background; fetched PDFs are kept here so the
+// download button does not request the same report twice.
+const reportBlobs = {};
+
+// Poll the report URL until the background task has written the PDF
+async function pollReport(analysisId, reportUrl, attempts = 30, delayMs = 2000) {
+  const url = `${API_URL}${
+    reportUrl || `/api/download/report/${analysisId}`
+  }`;
+
+  for (let i = 0; i < attempts; i++) {
+    try {
+      const response = await fetch(url, {
         headers: {
           Authorization: `Bearer ${localStorage.getItem("token")}`,
         },
+      });
+
+      if (response.ok) {
+        reportBlobs[analysisId] = await response.blob();
+        setReportButton("📄 Download PDF Report", false);
+        return;
+      }
+      if (!(await isReportPending(response))) {
+        // Generation failed (or the report is gone): stop waiting for it
+        setReportButton("⚠️ Report Unavailable", true);
+        showAlert(await reportErrorMessage(response), "error");
+        return;
       }
-    );
+    } catch (error) {
+      console.error("Report polling error:", error);
+    }
+    await new Promise((resolve) => setTimeout(resolve, delayMs));
+  }
 
-    if (response.ok) {
-      const blob = await response.blob();
+  // Give up polling but let the user retry manually
+  setReportButton("📄 Download PDF Report", false);
+}
+
+function setReportButton(label, disabled) {
+  const button = document.getElementById("downloadReportBtn");
+  if (!button) return;
+  button.textContent = label;
+  button.disabled = disabled;
+}
+
+// The download endpoint answers 404 "Report not ready" until the PDF exists
+async function isReportPending(response) {
+  if (response.status !== 404) return false;
+  try {
+    const data = await response.clone().json();
+    return data.detail === "Report not ready";
+  } catch (error) {
+    return false;
+  }
+}
+
+// Server-side reason for a failed download, e.g. "Report generation failed"
+async function reportErrorMessage(response) {
+  try {
+    const data = await response.clone().json();
+    if (data.detail) return `Failed to download report: ${data.detail}`;
+  } catch (error) {
+    // Not a JSON error body
+  }
+  return "Failed to download report";
+}
+
+// Download Report (Global function)
+window.downloadReport = async function (analysisId) {
+  try {
+    let blob = reportBlobs[analysisId];
+
+    if (!blob) {
+      const response = await fetch(
+        `${API_URL}/api/download/report/${analysisId}`,
+        {
+          headers: {
+            Authorization: `Bearer ${localStorage.getItem("token")}`,
+          },
+        }
+      );
+
+      if (await isReportPending(response)) {
+        showAlert("Report is still being generated, please try again shortly", "info");
+        return;
+      }
+      if (!response.ok) {
+        showAlert(await reportErrorMessage(response), "error");
+        return;
+      }
+      blob = await response.blob();
+    }
+
+    if (blob) {
       const url = window.URL.createObjectURL(blob);
       const a = document.createElement("a");
       a.href = url;
@@ -327,8 +416,6 @@ window.downloadReport = async function (analysisId) {
       document.body.removeChild(a);
 
       showAlert("Report downloaded successfully!", "success");
-    } else {
-      showAlert("Failed to download report", "error");
     }
   } catch (error) {
     console.error("Download error:", error);
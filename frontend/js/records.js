@@ -286,6 +286,28 @@ function showRecordModal(data, analysisId) {
   });
 }
 
+// The download endpoint answers 404 "Report not ready" until the PDF exists
+async function isReportPending(response) {
+  if (response.status !== 404) return false;
+  try {
+    const data = await response.clone().json();
+    return data.detail === "Report not ready";
+  } catch (error) {
+    return false;
+  }
+}
+
+// Server-side reason for a failed download, e.g. "Report generation failed"
+async function reportErrorMessage(response) {
+  try {
+    const data = await response.clone().json();
+    if (data.detail) return `Failed to download report: ${data.detail}`;
+  } catch (error) {
+    // Not a JSON error body
+  }
+  return "Failed to download report";
+}
+
 // Download Report (Global function)
 window.downloadReport = async function (analysisId) {
   try {
@@ -298,6 +320,11 @@ window.downloadReport = async function (analysisId) {
       }
     );
 
+    if (await isReportPending(response)) {
+      showAlert("Report is still being generated, please try again shortly", "info");
+      return;
+    }
+
     if (response.ok) {
       const blob = await response.blob();
       const url = window.URL.createObjectURL(blob);
@@ -311,7 +338,7 @@ window.downloadReport = async function (analysisId) {
 
       showAlert("Report downloaded successfully!", "success");
     } else {
-      showAlert("Failed to download report", "error");
+      showAlert(await reportErrorMessage(response), "error");
     }
   } catch (error) {
     console.error("Download error:", error);